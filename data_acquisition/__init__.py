@@ -1,3 +1,57 @@
-from data_scrapers import *
-from db_updaters import *
-from setup_mongodb import *
\ No newline at end of file
+'''
+The submodules are only imported when one of their names is first used,
+so e.g. importing NotePageParser doesn't pull in mechanize or pymongo.
+'''
+
+import sys
+import types
+import importlib
+
+_lazy_names = {
+    'PageCrawler': 'data_scrapers',
+    'NoteOrders': 'data_scrapers',
+    'NotePageParser': 'parsers',
+    'LoanPageParser': 'parsers',
+    'NoteOrdersUpdater': 'db_updaters',
+    'NotePageUpdater': 'db_updaters',
+    'LoanPageUpdater': 'db_updaters',
+    'get_db': 'setup_mongodb',
+    'lazy_db': 'setup_mongodb',
+    'FetchController': 'rate_control',
+    'FetchError': 'rate_control',
+    'CircuitOpenError': 'rate_control',
+    'LoginError': 'rate_control',
+    'SessionManager': 'sessions',
+    'TextStore': 'text_store',
+    'NotePageScheduler': 'scheduling',
+    'InventoryWatcher': 'inventory_feed',
+    'InventoryEvent': 'inventory_feed',
+    'AnalyticsView': 'analytics',
+    'Exporter': 'export',
+    'DocCache': 'cache',
+    'WriteBehind': 'cache',
+    'doc_caches': 'cache',
+    }
+
+__all__ = sorted(_lazy_names)
+
+
+class _LazyPackage(types.ModuleType):
+    '''module type that imports the submodule holding a name on first access'''
+
+    def __getattr__(self, name):
+        try:
+            module_name = _lazy_names[name]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+        value = getattr(importlib.import_module('.' + module_name, __name__), name)
+        setattr(self, name, value)
+        return value
+
+
+# keep a reference to the real module, otherwise its globals
+# (which _LazyPackage uses) are cleared when it is replaced
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+_package._original = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -0,0 +1,112 @@
+'''
+A flattened, per note view of db.notes joined with db.loans, for analysis.
+
+db.note_analytics holds one small document per note with the current
+price/ytm/markup, the loan terms and status, and summary stats of the
+payment history, so analyses don't have to join notes to loans in Python
+or read the unbounded time series arrays.
+
+The view is refreshed incrementally: the updaters record which notes and
+loans they wrote to in 'touched_notes' / 'touched_loans', and only those
+rows are recomputed. A change to a loan refreshes every note of that loan.
+'rebuild' recomputes everything and is only needed to fill the view the
+first time.
+'''
+
+import datetime
+
+# only the latest entry of the time series is needed
+NOTE_FIELDS = {'asking_price':{'$slice':-1},
+               'ytm':{'$slice':-1},
+               'markup_discount':{'$slice':-1}}
+
+LOAN_FIELDS = {'loanID':1, 'loan_grade':1, 'interest_rate':1,
+               'loan_length':1, 'amount_requested':1,
+               'status':1, 'loan_status':1}
+
+
+class AnalyticsView(object):
+
+    def __init__(self, dbh, batch_size=500):
+        self.notes = dbh.notes
+        self.loans = dbh.loans
+        self.view = dbh.note_analytics
+        self.batch_size = batch_size
+
+    def refresh(self, note_ids=(), loan_ids=()):
+        '''recompute the rows of the given notes and of every note of the given loans'''
+        note_ids = set(note_ids)
+        loan_ids = list(loan_ids)
+        for i in range(0, len(loan_ids), self.batch_size):
+            chunk = loan_ids[i:i+self.batch_size]
+            for note in self.notes.find({'loanID':{'$in':chunk}}, {'noteID':1}):
+                note_ids.add(note['noteID'])
+
+        note_ids = list(note_ids)
+        for i in range(0, len(note_ids), self.batch_size):
+            self.refresh_batch(note_ids[i:i+self.batch_size])
+        print 'Refreshed %s rows of note_analytics' % len(note_ids)
+
+    def refresh_from(self, *updaters):
+        '''refresh everything the given updaters touched in their last update'''
+        note_ids, loan_ids = set(), set()
+        for u in updaters:
+            note_ids.update(getattr(u, 'touched_notes', ()))
+            loan_ids.update(getattr(u, 'touched_loans', ()))
+        self.refresh(note_ids, loan_ids)
+
+    def rebuild(self):
+        '''recompute the whole view from a full scan of db.notes'''
+        self.refresh([n['noteID'] for n in self.notes.find({}, {'noteID':1})])
+
+    def refresh_batch(self, note_ids):
+        notes = list(self.notes.find({'noteID':{'$in':note_ids}}, NOTE_FIELDS))
+        loan_ids = list(set(n['loanID'] for n in notes if 'loanID' in n))
+        loans = {}
+        for loan in self.loans.find({'loanID':{'$in':loan_ids}}, LOAN_FIELDS):
+            loans[loan['loanID']] = loan
+
+        now = datetime.datetime.utcnow()
+        for note in notes:
+            row = AnalyticsView.make_row(note, loans.get(note.get('loanID'), {}))
+            row['refreshed_at'] = now
+            self.view.update({'noteID':row['noteID']}, {'$set':row},
+                             upsert=True, safe=True)
+
+    @staticmethod
+    def make_row(note, loan):
+        '''flatten a note document and its loan document into one row'''
+        row = {'noteID':note['noteID'],
+               'loanID':note.get('loanID'),
+               'orderID':note.get('orderID'),
+               'trading_status':note.get('trading_status'),
+               'outstanding_principal':note.get('outstanding_principal'),
+               'accrued_interest':note.get('accrued_interest'),
+               'payments_to_date':note.get('payments_to_date'),
+               'remaining_payments':note.get('remaining_payments'),
+               'loan_grade':loan.get('loan_grade'),
+               'interest_rate':loan.get('interest_rate'),
+               'loan_length':loan.get('loan_length'),
+               'amount_requested':loan.get('amount_requested'),
+               # 'status' comes from the note pages and is the more recent
+               'status':loan.get('status', loan.get('loan_status')),
+               }
+
+        for field in ['asking_price', 'ytm', 'markup_discount']:
+            series = note.get(field) or [{}]
+            row[field] = series[-1].get(field)
+        row['price_time'] = (note.get('asking_price') or [{}])[-1].get('time')
+
+        row.update(AnalyticsView.payment_stats(note.get('payment_history', [])))
+        return row
+
+    @staticmethod
+    def payment_stats(payments):
+        paid = [p for p in payments if 'completion_date' in p]
+        late = [p for p in payments
+                if 'late' in p.get('status', '').lower() or p.get('late_fees', 0) > 0]
+        return {'num_payments':len(paid),
+                'num_late_payments':len(late),
+                'total_received':round(sum(p.get('amount', 0) for p in paid), 2),
+                'last_payment_date':max([p['completion_date'] for p in paid] or [None]),
+                }
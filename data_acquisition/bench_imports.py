@@ -0,0 +1,99 @@
+'''
+Measures the cold-start (import) time of each entry point of the package.
+
+Every import is done in a fresh interpreter, so nothing is cached between
+measurements. The heavy third party modules that each entry point ends up
+loading are reported too, so a change that makes e.g. the parsers pull in
+pymongo again shows up straight away.
+
+usage: python -m data_acquisition.bench_imports [-n repeats] [--csv file]
+
+With --csv the results are appended to 'file' with a timestamp so cold-start
+time can be tracked over time.
+'''
+
+import os
+import sys
+import csv
+import json
+import datetime
+import argparse
+import subprocess
+
+ENTRY_POINTS = ['data_acquisition',
+                'data_acquisition.parsers',
+                'data_acquisition.setup_mongodb',
+                'data_acquisition.rate_control',
+                'data_acquisition.sessions',
+                'data_acquisition.text_store',
+                'data_acquisition.scheduling',
+                'data_acquisition.inventory_feed',
+                'data_acquisition.analytics',
+                'data_acquisition.export',
+                'data_acquisition.cache',
+                'data_acquisition.data_scrapers',
+                'data_acquisition.db_updaters',
+                ]
+
+HEAVY_MODULES = ['mechanize', 'cookielib', 'BeautifulSoup', 'pymongo']
+
+TIMER = '''
+import sys, time, json
+t = time.time()
+import %s
+t = time.time() - t
+print json.dumps({'seconds': t, 'loaded': [m for m in %r if m in sys.modules]})
+'''
+
+def time_import(module):
+    '''import module in a new interpreter, return (seconds, heavy modules loaded)'''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.check_output([sys.executable, '-c', TIMER % (module, HEAVY_MODULES)],
+                                  cwd=root)
+    result = json.loads(out.strip().split('\n')[-1])
+    return result['seconds'], result['loaded']
+
+def bench(repeats):
+    '''return a list of (entry point, best time, median time, heavy modules loaded)'''
+    results = []
+    for module in ENTRY_POINTS:
+        try:
+            times = []
+            for i in range(repeats):
+                t, loaded = time_import(module)
+                times.append(t)
+        except subprocess.CalledProcessError:
+            # a dependency isn't installed here
+            results.append((module, None, None, []))
+            continue
+        times.sort()
+        results.append((module, times[0], times[len(times)/2], loaded))
+    return results
+
+def report(results):
+    print '%-32s %10s %10s  %s' % ('entry point', 'best (ms)', 'median', 'loads')
+    for module, best, median, loaded in results:
+        if best is None:
+            print '%-32s %10s %10s' % (module, 'failed', '')
+            continue
+        print '%-32s %10.1f %10.1f  %s' % (module, best*1000, median*1000, ', '.join(loaded))
+
+def append_csv(results, filename):
+    now = datetime.datetime.utcnow().isoformat()
+    with open(filename, 'ab') as f:
+        w = csv.writer(f)
+        for module, best, median, loaded in results:
+            w.writerow([now, module, best, median, ' '.join(loaded)])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='time cold imports of data_acquisition')
+    parser.add_argument('-n', type=int, default=5, help='imports per entry point')
+    parser.add_argument('--csv', help='append results to this csv file')
+    args = parser.parse_args()
+
+    results = bench(args.n)
+    report(results)
+    if args.csv is not None:
+        append_csv(results, args.csv)
@@ -0,0 +1,223 @@
+'''
+Caching of loan and note documents across the updater stages.
+
+Within a run the updaters look up the same documents over and over, e.g.
+the scheduler reads a loan once for every note of that loan. DocCache is a
+size bounded LRU read-through cache of one collection, keyed by loanID or
+noteID. It only keeps the fields the updaters read, not the long arrays.
+Whoever writes a document must invalidate it; a write that matches on
+another field (e.g. all notes of a loan) invalidates that group, see
+'group_by'.
+
+WriteBehind does the same for writes: updates to a document are merged in
+memory and sent as one update per document when flushed, instead of one
+per field per note. Flushing invalidates the cached copies.
+
+The working set is the whole foliofn inventory: the scheduler reads every
+listed note and its loan, and the note page stage reads them again. A
+cache smaller than that evicts everything before the second read, so the
+updaters grow the caches to the inventory size (ensure_capacity) once they
+know it, up to 'max_capacity' documents. That costs a few hundred bytes per
+note and loan, i.e. tens of MB at the default cap.
+
+Other processes write to the same collections (the cron updaters, the
+inventory watcher), so a cache is only good for one run: every update()
+and every inventory poll starts with clear(), which also shrinks the cache
+back to its initial size.
+
+The caches are shared by all updaters of a db, see doc_caches(), and so
+by the InventoryWatcher thread too. DocCache is safe to use from several
+threads; a WriteBehind belongs to the thread that created it.
+'''
+
+import threading
+from collections import OrderedDict
+from setup_mongodb import lazy_db
+
+
+class DocCache(object):
+
+    def __init__(self, collection, key, fields, max_size=50000, group_by=None,
+                 max_capacity=200000):
+        '''
+        'key' is the ID field (e.g. 'loanID'), 'fields' the projection
+        used to read documents, 'max_size' the number of documents kept,
+        which ensure_capacity() grows up to 'max_capacity'.
+        'group_by' is a field (in 'fields') whose cached documents can be
+        invalidated together with invalidate_group().
+        '''
+        self.collection = collection
+        self.key = key
+        self.fields = fields
+        self.max_size = max_size
+        self.initial_size = max_size
+        self.max_capacity = max_capacity
+        self.group_by = group_by
+        self.docs = OrderedDict()
+        # group_by value -> IDs of the cached documents with that value
+        self.groups = {}
+        self.lock = threading.RLock()
+        # bumped by every invalidation, a lookup that raced one isn't cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, doc_id):
+        '''return the (projected) document with this ID, or None if there isn't one'''
+        with self.lock:
+            if doc_id in self.docs:
+                self.hits += 1
+                # move to the most recently used end
+                doc = self.docs.pop(doc_id)
+                self.docs[doc_id] = doc
+                return doc
+            self.misses += 1
+            generation = self.generation
+
+        # don't hold the lock over the db round trip
+        doc = self.collection.find_one({self.key:doc_id}, self.fields)
+
+        with self.lock:
+            if self.generation != generation:
+                # something was invalidated meanwhile, doc may predate that write
+                return doc
+            # missing documents are cached as None
+            self.docs.pop(doc_id, None)
+            self.docs[doc_id] = doc
+            if self.group_by is not None and doc is not None:
+                self.groups.setdefault(doc.get(self.group_by), set()).add(doc_id)
+            if len(self.docs) > self.max_size:
+                self.forget(*self.docs.popitem(last=False))
+                self.evictions += 1
+        return doc
+
+    def ensure_capacity(self, n):
+        '''make room for n documents, but no more than max_capacity'''
+        with self.lock:
+            self.max_size = max(self.max_size, min(n, self.max_capacity))
+
+    def invalidate(self, doc_id):
+        with self.lock:
+            self.generation += 1
+            if doc_id in self.docs:
+                self.forget(doc_id, self.docs.pop(doc_id))
+
+    def invalidate_group(self, value):
+        '''invalidate every cached document whose group_by field is value'''
+        with self.lock:
+            self.generation += 1
+            for doc_id in list(self.groups.get(value, [])):
+                self.invalidate(doc_id)
+
+    def forget(self, doc_id, doc):
+        '''drop a document that left the cache from its group'''
+        if self.group_by is None or doc is None:
+            return
+        value = doc.get(self.group_by)
+        group = self.groups.get(value)
+        if group is not None:
+            group.discard(doc_id)
+            if len(group) == 0:
+                del self.groups[value]
+
+    def clear(self):
+        '''drop every document and go back to the initial size'''
+        with self.lock:
+            self.generation += 1
+            self.docs.clear()
+            self.groups.clear()
+            self.max_size = self.initial_size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits':self.hits, 'misses':self.misses,
+                    'evictions':self.evictions, 'size':len(self.docs),
+                    'hit_rate':float(self.hits) / lookups if lookups > 0 else 0.0}
+
+
+class WriteBehind(object):
+    '''
+    Collects $set and $addToSet updates per document and writes each
+    document once on flush(). All writes are upserts.
+    '''
+
+    def __init__(self, collection, key, cache=None):
+        self.collection = collection
+        self.key = key
+        self.cache = cache
+        self.pending = OrderedDict()
+        self.writes = 0
+
+    def set(self, doc_id, fields):
+        self.ops(doc_id)['$set'].update(fields)
+
+    def add_to_set(self, doc_id, field, values):
+        added = self.ops(doc_id)['$addToSet'].setdefault(field, [])
+        for v in values:
+            if v not in added:
+                added.append(v)
+
+    def ops(self, doc_id):
+        if doc_id not in self.pending:
+            self.pending[doc_id] = {'$set':{}, '$addToSet':{}}
+        return self.pending[doc_id]
+
+    def flush(self):
+        for doc_id, ops in self.pending.iteritems():
+            update = {}
+            if len(ops['$set']) > 0:
+                update['$set'] = ops['$set']
+            if len(ops['$addToSet']) > 0:
+                update['$addToSet'] = dict((f, {'$each':vals})
+                                           for f, vals in ops['$addToSet'].iteritems())
+            self.collection.update({self.key:doc_id}, update, upsert=True, safe=True)
+            self.writes += 1
+            if self.cache is not None:
+                self.cache.invalidate(doc_id)
+        self.pending = OrderedDict()
+
+
+class DBCache(object):
+    '''the loan and note caches of one db'''
+
+    # what the updaters read, time series only need their latest entry
+    note_fields = {'noteID':1, 'loanID':1, 'last_updated':1,
+                   'outstanding_principal':1, 'accrued_interest':1,
+                   'asking_price':{'$slice':-1},
+                   'ytm':{'$slice':-1},
+                   'markup_discount':{'$slice':-1}}
+
+    loan_fields = {'loanID':1, 'status':1, 'last_updated':1}
+
+    def __init__(self, dbh, max_size=50000, max_capacity=200000):
+        self.notes = DocCache(dbh.notes, 'noteID', self.note_fields, max_size,
+                              group_by='loanID', max_capacity=max_capacity)
+        self.loans = DocCache(dbh.loans, 'loanID', self.loan_fields, max_size,
+                              max_capacity=max_capacity)
+
+    def ensure_capacity(self, n_notes):
+        '''size both caches for n_notes notes (and at most as many loans)'''
+        self.notes.ensure_capacity(n_notes)
+        self.loans.ensure_capacity(n_notes)
+
+    def clear(self):
+        '''start a new run, nothing read before is trusted'''
+        self.notes.clear()
+        self.loans.clear()
+
+    def report(self):
+        for name in ['loans', 'notes']:
+            s = getattr(self, name).stats()
+            print '%s cache: %s hits, %s misses (%.0f%%), %s evictions' % \
+                (name, s['hits'], s['misses'], 100 * s['hit_rate'], s['evictions'])
+
+
+_db_caches = {}
+
+def doc_caches(db_name):
+    '''return the DBCache shared by everything using db_name'''
+    if db_name not in _db_caches:
+        _db_caches[db_name] = DBCache(lazy_db(db_name))
+    return _db_caches[db_name]
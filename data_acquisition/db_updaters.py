@@ -13,6 +13,8 @@ The DB is currently has two collections:
 2.) Loans
 
 Each source/class above may update one or both of these collections at once.
+Every write also sets 'modified', which incremental exports key on.
+'last_updated' is only set when a note page is crawled.
 
 #################
 Update Scheduling
@@ -23,18 +25,31 @@ updated weekly or so, or whenever the NoteOrder changes.
 '''
 
 import datetime
-from data_scrapers import NoteOrders, PageCrawler, LoanPageParser, NotePageParser
-from setup_mongodb import get_db
+from data_scrapers import NoteOrders, PageCrawler
+from parsers import LoanPageParser, NotePageParser
+from setup_mongodb import lazy_db
+from rate_control import FetchController
+from sessions import SessionManager
+from text_store import TextStore
+from scheduling import NotePageScheduler
+from analytics import AnalyticsView
+from cache import doc_caches, WriteBehind
 
 class NoteOrdersUpdater(object):
     
-    def __init__(self):
-        self.notes = get_db('lc_db').notes
-        self.NO = NoteOrders()
+    def __init__(self, session):
+        self.notes = lazy_db('lc_db').notes
+        self.cache = doc_caches('lc_db')
+        self.NO = NoteOrders(session=session)
+        # noteIDs written to in the last update, see AnalyticsView
+        self.touched_notes = set()
 
     def update(self):
         print 'Pulling new data from foliofn...'
+        self.touched_notes = set()
+        self.cache.clear()
         self.NO.grab_data(0, 999999)
+        self.cache.ensure_capacity(len(self.NO.get_data()))
         print 'Updating DB...'
         for note in self.NO.get_data():
             self.update_note(note)
@@ -52,41 +67,53 @@ class NoteOrdersUpdater(object):
         If a note exists, update the time series data
         '''
             
-        note_doc = self.notes.find_one({'noteID':int(note['noteId'])})
+        noteID = int(note['noteId'])
+        note_doc = self.cache.notes.get(noteID)
         if note_doc is None:
             self.notes.insert(self.create_note_doc(note))
-        else:
-            self.update_field(note, note_doc, 'asking_price')
-            self.update_field(note, note_doc, 'ytm')
-            self.update_field(note, note_doc, 'markup_discount')  
-            self.notes.update({'noteID':note['noteId']},
-                              {'$set': {'outstanding_principal':float(note['outstanding_principal']),
-                                        'accrued_interest':float(note['accrued_interest'])
-                                        }
-                               }, safe=True
-                              )
+            self.cache.notes.invalidate(noteID)
+            self.touched_notes.add(noteID)
+            return
+        
+        changed = False
+        for field in ['asking_price', 'ytm', 'markup_discount']:
+            changed = self.update_field(note, note_doc, field) or changed
+        
+        current = {'outstanding_principal':float(note['outstanding_principal']),
+                   'accrued_interest':float(note['accrued_interest'])
+                   }
+        if any(note_doc.get(k) != v for k,v in current.iteritems()):
+            current['modified'] = datetime.datetime.utcnow()
+            self.notes.update({'noteID':noteID}, {'$set': current}, safe=True)
+            changed = True
+        
+        if changed:
+            self.cache.notes.invalidate(noteID)
+            self.touched_notes.add(noteID)
             
     def update_field(self, note, note_doc, field):
         '''
         Update a field in a note document which is an array
         of subdocuments if the value of the last entry is different
-        from the current measurement
+        from the current measurement. Returns True if it was updated.
         '''
 
         subdoc = note_doc.get(field,None)
         try:
             if subdoc is not None and subdoc[-1][field] == float(note[field]):
-                return
+                return False
         except ValueError:
-            return
+            return False
         
         self.notes.update({'noteID':int(note['noteId'])},
                           {"$push":{field:{field:float(note[field]),
                                            'time':datetime.datetime.utcnow()
                                            }
-                                    }
+                                    },
+                           '$set':{'modified':datetime.datetime.utcnow()}
                            }, safe=True
                           )   
+        return True
         
     def create_note_doc(self, note):
         '''
@@ -106,6 +133,7 @@ class NoteOrdersUpdater(object):
                 'trading_status':True,
                 'outstanding_principal':float(note['outstanding_principal']),
                 'accrued_interest':float(note['accrued_interest']),
+                'modified':datetime.datetime.utcnow(),
                 }
         except:
             raise Exception('unable to create new note document')
@@ -125,110 +153,150 @@ class NotePageUpdater(object):
     
     Only fetches a NotePage if the note has changed
     or if the NotePage hasn't been updated in the last
-    week.
+    week. Pages are fetched in order of priority (see
+    NotePageScheduler), at most 'budget' of them per update.
+    
+    Note pages that couldn't be fetched are saved to 'dead_letter_file'
+    and crawled first on the next update.
     '''
-    def __init__(self):
-        dbh = get_db('lc_db')
+    def __init__(self, session, dead_letter_file='note_page_dead_letters.json'):
+        dbh = lazy_db('lc_db')
         self.notes = dbh.notes
         self.loans = dbh.loans
+        self.cache = doc_caches('lc_db')
+        self.session = session
+        # IDs written to in the last update, see AnalyticsView
+        self.touched_notes = set()
+        self.touched_loans = set()
+        self.dead_letter_file = dead_letter_file
         
         self.note_page_url = 'https://www.lendingclub.com/foliofn/loanPerf.action?loan_id=%s&order_id=%s&note_id=%s'
         self.login_str = 'Only Lending Club investors can sign up as trading members'
     
-    def update(self, wait=2.5, batch_size=1000, days_old=7):
-        note_tups = self.note_page_scheduler(days_old) #(loanID,orderID,noteID)
+    def update(self, wait=2.5, batch_size=1000, days_old=7, budget=None):
+        self.cache.clear()
+        scheduler = self.note_page_scheduler(days_old, budget)
+        self.controller = FetchController(delay=wait)
+        self.touched_notes = set()
+        self.touched_loans = set()
+        
+        # log in (if the saved session can't be used) and fill the
+        # browser pool before the crawl starts
+        self.session.warm()
+        
+        # pages that failed last time go first
+        retries = set(FetchController.load_dead_letters(self.dead_letter_file))
+        for note_tup in retries:
+            scheduler.push(note_tup, float('inf'))
 
-        while len(note_tups)>0:
-            # create subset of loans to crawl for
-            notes = []
-            for i in range(batch_size):
-                try:
-                    notes.append(note_tups.pop())
-                except IndexError:
+        try:
+            while len(scheduler)>0:
+                # create subset of the highest priority notes to crawl for
+                notes = scheduler.pop_batch(batch_size) #(loanID,orderID,noteID)
+                notes_html, finished = self.get_note_pages(notes, wait)
+                retries.difference_update(notes)
+                self.parse_and_insert(notes_html)
+                if not finished:
+                    print 'LC keeps failing, stopping. %s scheduled note pages left for the next update' % len(scheduler)
                     break
-            notes_html = self.get_note_pages(notes, wait)
-            self.parse_and_insert(notes_html)
+        finally:
+            # retries that weren't reached this time are kept for the next
+            # update, pages that failed for good are dropped
+            if len(self.controller.failed) > 0:
+                print 'Gave up on %s note pages for good: %s' % \
+                    (len(self.controller.failed), self.controller.failed)
+            self.controller.save_dead_letters(self.dead_letter_file, retries)
 
     def get_note_pages(self, note_tups, wait):
-        PC = PageCrawler(self.note_page_url, self.login_str, wait)    
-        PC.crawl(note_tups)
-        return PC.get_data()
+        '''returns (html by note tuple, whether the crawl got through the batch)'''
+        PC = PageCrawler(self.note_page_url, self.login_str, sleep_time=wait,
+                         controller=self.controller, session=self.session)    
+        try:
+            finished = PC.crawl(note_tups)
+        finally:
+            PC.close()
+        return PC.get_data(), finished
 
     def parse_and_insert(self, pages):
+        '''
+        Parse the note pages and write them to db.notes and db.loans.
+        Writes are collected per note and per loan and sent once each at
+        the end, a loan with many notes in the batch is only written once,
+        and the other notes of the crawled loans are stamped in one update.
+        They are sent even if the batch fails part way through.
+        '''
         NP = NotePageParser()
-        for p in pages:
-            loanID,orderID,noteID = p
-            try:
-                doc = NP.parse_html(pages[p])
-            except:
-                print 'Failed to parse (loanID: %s,orderID: %s,noteID: %s)' % (loanID,orderID,noteID)
-                continue
+        notes = WriteBehind(self.notes, 'noteID', self.cache.notes)
+        loans = WriteBehind(self.loans, 'loanID', self.cache.loans)
+        crawled_loans = set()
+        try:
+            for p in pages:
+                loanID,orderID,noteID = p
+                try:
+                    doc = NP.parse_html(pages[p])
+                except:
+                    print 'Failed to parse (loanID: %s,orderID: %s,noteID: %s)' % (loanID,orderID,noteID)
+                    continue
+                self.touched_notes.add(noteID)
+                self.touched_loans.add(loanID)
+                now = datetime.datetime.utcnow()
 
-            # upsert collection log
-            try:
-                collections = doc['collection_log']
-                self.loans.update({'loanID':loanID},
-                                  {'$addToSet':{'collection_log':{'$each':collections}}},
-                                  upsert=True, safe=True)
-            except KeyError:
-                pass
+                # upsert collection log
+                if 'collection_log' in doc:
+                    loans.add_to_set(loanID, 'collection_log', doc['collection_log'])
   
-            # update status
-            self.loans.update({'loanID':loanID},
-                              {'$set':{'status':doc['status']}},
-                              upsert=True, safe=True)     
+                # update status
+                loans.set(loanID, {'status':doc['status'], 'last_updated':now, 'modified':now})
                  
-            ## note ID and amount/fraction --> loan
-            note_fraction = {'noteID':noteID, 'loan_fraction':doc['loan_fraction']}
-            self.loans.update({'loanID':loanID},
-                              {'$addToSet':{'notes':note_fraction}},
-                              upsert=True, safe=True)
-            # payment --> note
-            try:
-                collections = doc['payment_history']
-                self.notes.update({'noteID':noteID},
-                                  {'$addToSet':{'payment_history':{'$each':collections}}},
-                                  upsert=True, safe=True)
-            except KeyError:
-                pass
+                ## note ID and amount/fraction --> loan
+                note_fraction = {'noteID':noteID, 'loan_fraction':doc['loan_fraction']}
+                loans.add_to_set(loanID, 'notes', [note_fraction])
             
-            # credit score history --> loan
-            try:
-                csh = doc['credit_score_range']
-                self.loans.update({'loanID':loanID},
-                                  {'$addToSet':{'credit_score_history':{'$each':csh}}},
-                                  upsert=True, safe=True)
-            except KeyError:
-                pass
+                # payment --> note
+                if 'payment_history' in doc:
+                    notes.add_to_set(noteID, 'payment_history', doc['payment_history'])
             
-            # summary --> note
-            self.notes.update({'noteID':noteID},
-                              {'$set':{'last_payment':doc['last_payment'],
-                                       'payments_to_date':doc['payments_to_date'],
-                                       'principal':doc['principal'],
-                                       'interest':doc['interest'],
-                                       'late_fees_received':doc['late_fees_received'],
-                                       'next_payment':doc['next_payment'],
-                                       'remaining_payments':doc['remaining_payments'],
-                                       'expected_final_payment':doc['expected_final_payment'],
-                                       'outstanding_principal':doc['outstanding_principal'],
-                                       }}, upsert=True, safe=True)
+                # credit score history --> loan
+                if 'credit_score_range' in doc:
+                    loans.add_to_set(loanID, 'credit_score_history', doc['credit_score_range'])
             
-            # add normalized (total loan amount) payment history to loan
-            loan_pay = self.normalize_payments(doc)
-            self.loans.update({'loanID':loanID},
-                              {'$addToSet':{'payment_history':{'$each':loan_pay}}},
-                              upsert=True, safe=True)
+                # summary --> note, and update last updated
+                notes.set(noteID, {'last_payment':doc['last_payment'],
+                                   'payments_to_date':doc['payments_to_date'],
+                                   'principal':doc['principal'],
+                                   'interest':doc['interest'],
+                                   'late_fees_received':doc['late_fees_received'],
+                                   'next_payment':doc['next_payment'],
+                                   'remaining_payments':doc['remaining_payments'],
+                                   'expected_final_payment':doc['expected_final_payment'],
+                                   'outstanding_principal':doc['outstanding_principal'],
+                                   'last_updated':now,
+                                   'modified':now,
+                                   })
             
-            #update last updated
-            self.notes.update({'noteID':noteID},
-                              {'$set':{'last_updated':datetime.datetime.utcnow()}
-                               }
-                              )
-            self.notes.update({'loanID':loanID},
-                              {'$set':{'last_updated':datetime.datetime.utcnow()}
-                               }, safe=True
-                              )
+                # add normalized (total loan amount) payment history to loan
+                loans.add_to_set(loanID, 'payment_history', self.normalize_payments(doc))
+            
+                crawled_loans.add(loanID)
+            
+        finally:
+            # write what was parsed even if a page blew up half way
+            try:
+                notes.flush()
+                self.stamp_loan_notes(crawled_loans)
+            finally:
+                loans.flush()
+
+    def stamp_loan_notes(self, loanIDs):
+        '''mark every note of the crawled loans as updated, one write for all of them'''
+        if len(loanIDs) == 0:
+            return
+        now = datetime.datetime.utcnow()
+        self.notes.update({'loanID':{'$in':list(loanIDs)}},
+                          {'$set':{'last_updated':now, 'modified':now}},
+                          multi=True, safe=True)
+        for loanID in loanIDs:
+            self.cache.notes.invalidate_group(loanID)
     
     def normalize_payments(self, doc):
         '''
@@ -248,31 +316,36 @@ class NotePageUpdater(object):
             loan_pay_hist.append(new_pay)
         return loan_pay_hist
     
-    def note_page_scheduler(self, days_old):
+    def note_page_scheduler(self, days_old, budget=None):
         '''
-        return a list of (loanID,orderID,noteID) tuples for
-        note pages that are out of date or whose note orders
-        have recently changed.
+        return a NotePageScheduler holding (loanID,orderID,noteID) tuples
+        for note pages that are out of date or whose note orders
+        have recently changed, scored by how urgently they need crawling.
         '''
-        NO = NoteOrders()
+        NO = NoteOrders(session=self.session)
         NO.grab_data(0, 999999)
-        np_tups = []
+        # every listed note and its loan is read here and again when the
+        # pages are stored, keep them all
+        self.cache.ensure_capacity(len(NO.get_data()))
+        scheduler = NotePageScheduler(days_old=days_old, budget=budget)
         for note_order in NO.get_data():
-            if self.out_of_date(note_order, days_old) or self.order_changed(note_order):
-                try:
-                    np_tups.append((int(note_order['loanGUID']), 
-                                    int(note_order['orderId']),
-                                    int(note_order['noteId'])))
-                except KeyError:
-                    continue
-        return np_tups
+            try:
+                note_tup = (int(note_order['loanGUID']), 
+                            int(note_order['orderId']),
+                            int(note_order['noteId']))
+            except KeyError:
+                continue
+            loan = self.cache.loans.get(note_tup[0])
+            note = self.cache.notes.get(note_tup[2])
+            if self.out_of_date(loan, days_old) or self.order_changed(note_order, note):
+                scheduler.push(note_tup, scheduler.score(note_order, note, loan))
+        return scheduler
     
-    def out_of_date(self, note_order, days_old):
+    def out_of_date(self, loan, days_old):
         '''
         check to see if a note is out of date
         '''
         try:
-            loan = self.loans.find_one({'loanID':int(note_order['loanGUID'])})
             if (datetime.datetime.utcnow() - loan['last_updated']).days < days_old:
                 return False                   
         except:
@@ -280,18 +353,23 @@ class NotePageUpdater(object):
         
         return True
     
-    def order_changed(self, note_order):
+    def order_changed(self, note_order, note):
         '''
-        check to see if a note_order has changed
+        check to see if a note_order has changed since the note was stored
         '''
-        fields = ['asking_price','outstanding_principal','days_since_payment','accrued_interest']
-        note = self.notes.find_one({'noteID':int(note_order['noteId'])})
-        for f in fields:
+        if note is None:
+            return True
+        for f in NotePageScheduler.change_fields:
             try:
-                if float(note[f]) != float(note_order[f]):
-                    return True
-            except:
+                # asking_price is a time series ($slice'd to its last entry)
+                old = NotePageScheduler.latest(note[f], f)
+            except (KeyError, IndexError, TypeError, ValueError):
                 return True
+            try:
+                if float(note_order[f]) != old:
+                    return True
+            except (KeyError, ValueError):
+                continue
         
         return False
 
@@ -305,18 +383,27 @@ class LoanPageUpdater(object):
     
     Must run NoteOrdersUpdater first to have up-to-date info
     in the DB about which loan pages to grab
+    
+    Descriptions and Q&A text are kept in db.texts (see TextStore),
+    'compress_text' zlib compresses them there.
     '''
-    def __init__(self):
-        dbh = get_db('lc_db')
+    def __init__(self, session, compress_text=False):
+        dbh = lazy_db('lc_db')
         self.notes = dbh.notes
         self.loans = dbh.loans
+        self.text_store = TextStore(dbh.texts, compress=compress_text)
+        self.cache = doc_caches('lc_db')
+        self.session = session
+        # loanIDs written to in the last update, see AnalyticsView
+        self.touched_loans = set()
         
         self.loan_page_url = 'https://www.lendingclub.com/browse/loanDetail.action?loan_id=%s'
         self.loan_page_login_str = 'This information is only accessible once you register as an Investor'
-        
-        self.NO = NoteOrders()
 
     def update(self, wait=2.5, batch_size=1000):              
+        self.touched_loans = set()
+        self.cache.clear()
+        self.text_store.seen.clear()
         self.get_new_loan_pages(wait, batch_size)
                         
     def get_new_loan_pages(self, wait, N):
@@ -326,8 +413,11 @@ class LoanPageUpdater(object):
         # pull N loan pages at a time and insert into DB
         counter = 0
         num_loanids = len(loanids)
+        controller = FetchController(delay=wait)
+        self.session.warm()
         while len(loanids)>0:
-            LC = PageCrawler(self.loan_page_url, self.loan_page_login_str, wait)
+            LC = PageCrawler(self.loan_page_url, self.loan_page_login_str, sleep_time=wait,
+                             controller=controller, session=self.session)
             
             # create subset of loans to crawl for
             loans_to_grab = []
@@ -337,59 +427,77 @@ class LoanPageUpdater(object):
                 except IndexError:
                     break
                 
-            LC.crawl(loans_to_grab)
+            try:
+                finished = LC.crawl(loans_to_grab)
+            finally:
+                LC.close()
             loans = LC.get_data()
            
             # parse loan and insert into DB
             for loanID in loans:
                 html = loans[loanID]
-                db_doc = LPP.parse_html(html)
+                db_doc = self.text_store.externalize(LPP.parse_html(html))
+                # not 'last_updated', that means the note pages are fresh
+                db_doc['modified'] = datetime.datetime.utcnow()
                 self.loans.update({'loanID':db_doc['loanID']},
                                   {'$set': db_doc}, upsert=True, safe=True)
+                self.cache.loans.invalidate(db_doc['loanID'])
+                self.touched_loans.add(db_doc['loanID'])
                 counter += 1
             print 'inserted loan %s of %s' % (counter, num_loanids)
+            if not finished:
+                print 'LC keeps failing, stopping. %s loan pages left' % len(loanids)
+                break
+        
+        # loans that weren't fetched are still missing from db.loans, so
+        # new_loans_set picks them up again on the next update
+        if len(controller.dead_letters) > 0:
+            print 'Failed to fetch %s loan pages, will retry next update: %s' % \
+                (len(controller.dead_letters), controller.dead_letters)
+        if len(controller.failed) > 0:
+            print 'Failed to fetch %s loan pages for good: %s' % \
+                (len(controller.failed), controller.failed)
         
     def new_loans_set(self):
         '''
         create a set of loanIDs whose pages have not
         already been crawled
         '''
-        # get unique set of loanIDs from notes
-        loanids = set()
-        for note in self.notes.find():
-            try:
-                loanids.add(note['loanID'])
-            except KeyError:
-                print note
+        # unique loanIDs of the notes, less the loans already in loan DB;
+        # only the IDs are read, not the documents
+        loanids = set(self.notes.distinct('loanID'))
+        loanids.discard(None)
+        for loan in self.loans.find({}, {'loanID':1, '_id':0}).batch_size(10000):
+            loanids.discard(loan.get('loanID'))
         loanids = list(loanids)
         
-        # remove loans already in loan DB
-        loans_already = []
-        for l in self.loans.find():
-            loans_already.append(l['loanID'])
-    
-        for loanID in loans_already:
-            if loanID in loanids:
-                loanids.remove(loanID)
-        
         print 'Retrieving %s loan pages' % len(loanids)
         
         return loanids
 
 
 if __name__ == '__main__':
+    
+    # one login, saved between runs and shared by all the updaters
+    session = SessionManager(login='', pwd='', cookie_file='lc_cookies.txt')
        
     print 'Updating Note Orders...'
-    NOU = NoteOrdersUpdater()
+    NOU = NoteOrdersUpdater(session)
     NOU.update()
     
     print 'Updating Loan Pages...'
-    LPU = LoanPageUpdater()
+    LPU = LoanPageUpdater(session)
     LPU.update(batch_size=300)
     
     print 'Updating Note Pages'
-    NPU = NotePageUpdater()
-    NPU.update(batch_size=300, days_old=5)
+    NPU = NotePageUpdater(session)
+    NPU.update(batch_size=300, days_old=5, budget=5000)
+    
+    print 'Refreshing note analytics...'
+    AV = AnalyticsView(lazy_db('lc_db'))
+    AV.refresh_from(NOU, LPU, NPU)
+    
+    doc_caches('lc_db').report()
     
 
     
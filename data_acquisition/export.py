@@ -0,0 +1,349 @@
+'''
+Streams lc_db.loans and lc_db.notes out to Parquet (or Arrow) files for
+offline modeling.
+
+Documents are read through a batched cursor and written out a row group of
+'rows_per_group' rows at a time, so memory use is bounded by that, not by
+the size of the collection. Each collection becomes a table of its scalar
+fields, and each array field becomes a child table keyed by the parent's ID
+plus the position in the array:
+
+    notes                  noteID, loanID, outstanding_principal, ...
+    notes_asking_price     noteID, idx, asking_price, time
+    notes_payment_history  noteID, idx, due_date, amount, status, ...
+    loans_QA               loanID, idx, question_ref, answer_ref, time
+    ...
+    texts                  text_id, text, length
+
+Long loan text is stored once in db.texts (see TextStore) and loans only
+hold its sha1 in the *_ref columns; join them to texts.text_id.
+
+Every export goes in its own partition, e.g.
+
+    out/notes/exported=20130512T060000/part-00000.parquet
+
+Each table is written to one file per export, against one schema. The
+schema is fixed from the first row group ever exported and kept in the
+state file, so column types stay the same across exports. Columns whose
+first rows mix types (e.g. 'n/a' in a column of ints) are strings. Values
+that don't fit their column's type are written as null and counted.
+Columns that first show up in a later export are added to the schema (the
+older files read them as null); ones that show up halfway through an export
+are left out of it and reported.
+
+Exports are incremental by default: only documents whose 'modified' time is
+newer than the previous export are written, the high water mark is kept in
+out/_export_state.json. Each export takes the documents modified up to the
+time it started, in 'modified' order (uses the index, see setup_mongodb),
+and the next one carries on from that time less CLOCK_SKEW, so documents
+written while an export runs aren't skipped. The updaters set 'modified' on
+every write; documents written before that have no 'modified' and need a
+'--full' export. Texts never change, they are exported by their 'created'
+time. A document updated since the last export (or modified within
+CLOCK_SKEW of its start) shows up again in the newer partition, so readers
+should keep the row from the latest partition. '--full' ignores the
+saved high water marks (but keeps the schemas).
+
+usage: python export.py out_dir [--full] [--format arrow]
+
+Needs pyarrow.
+'''
+
+import os
+import zlib
+import json
+import datetime
+import argparse
+
+KEYS = {'loans':'loanID', 'notes':'noteID', 'texts':'text_id'}
+
+# the field incremental exports are keyed on
+MODIFIED = {'loans':'modified', 'notes':'modified', 'texts':'created'}
+
+STATE_FILE = '_export_state.json'
+
+# how far the clocks of the processes writing 'modified' may be behind ours
+CLOCK_SKEW = datetime.timedelta(seconds=60)
+
+
+class TableWriter(object):
+    '''
+    Writes the rows of one table to a single file, a row group at a time,
+    every row group against the same schema.
+    '''
+
+    def __init__(self, path, rows_per_group, fmt, spec=None):
+        '''
+        'spec' is a list of [column, type name] pairs from earlier exports,
+        columns not in it are added from the first row group
+        '''
+        self.path = path
+        self.rows_per_group = rows_per_group
+        self.fmt = fmt
+        self.spec = [list(c) for c in spec or []]
+        self.rows = []
+        self.writer = None
+        self.sink = None
+        self.schema = None
+        self.dropped = set()
+        self.nulled = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.rows_per_group:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        import pyarrow as pa
+        if self.writer is None:
+            self.open(TableWriter.infer_spec(self.rows, self.spec))
+
+        arrays = []
+        for (name, t), field in zip(self.spec, self.schema):
+            col = [self.coerce(r.get(name), t) for r in self.rows]
+            arrays.append(pa.array(col, type=field.type))
+        for r in self.rows:
+            self.dropped.update(n for n in r if n not in self.schema.names)
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def open(self, spec):
+        import pyarrow as pa
+        types = {'int':pa.int64(), 'float':pa.float64(), 'string':pa.string(),
+                 'bool':pa.bool_(), 'timestamp':pa.timestamp('ms')}
+        self.spec = spec
+        self.schema = pa.schema([pa.field(name, types[t]) for name, t in spec])
+
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if self.fmt == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        else:
+            self.sink = pa.OSFile(self.path, 'wb')
+            self.writer = pa.RecordBatchFileWriter(self.sink, self.schema)
+
+    def close(self):
+        self.flush()
+        if self.writer is None:
+            return
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+        if len(self.dropped) > 0:
+            print 'Columns not in the schema of %s, not exported: %s' % \
+                (self.path, ', '.join(sorted(self.dropped)))
+        if self.nulled > 0:
+            print '%s values in %s did not fit their column type, written as null' % \
+                (self.nulled, self.path)
+
+    def coerce(self, val, t):
+        '''convert val to column type t, None (and count it) if it doesn't fit'''
+        if val is None:
+            return None
+        kind = TableWriter.kind(val)
+        if t == 'string':
+            return unicode(val)
+        if t == 'float' and kind == 'number':
+            return float(val)
+        if t == 'int' and kind == 'number' and float(val).is_integer():
+            return int(val)
+        if (t, kind) in [('bool', 'bool'), ('timestamp', 'datetime')]:
+            return val
+        self.nulled += 1
+        return None
+
+    @staticmethod
+    def infer_spec(rows, spec):
+        '''
+        add the columns of rows that aren't in spec yet. Scraped fields
+        aren't always one type (e.g. 'n/a' in a column of ints), such columns
+        are strings, as are values arrow has no type for
+        '''
+        spec = [list(c) for c in spec]
+        known = set(name for name, t in spec)
+        names = set()
+        for r in rows:
+            names.update(r)
+        for name in sorted(names - known):
+            col = [r.get(name) for r in rows]
+            kinds = set(TableWriter.kind(v) for v in col if v is not None)
+            if len(kinds) != 1 or 'other' in kinds:
+                t = 'string'
+            else:
+                t = {'bool':'bool', 'string':'string', 'datetime':'timestamp'}.get(kinds.pop())
+                if t is None:
+                    # IDs and positions are ints, other numbers are floats since
+                    # a column of whole numbers may get fractions later on
+                    ids = name == 'idx' or name.endswith('ID')
+                    ints = all(isinstance(v, (int, long)) for v in col if v is not None)
+                    t = 'int' if ids and ints else 'float'
+            spec.append([name, t])
+        return spec
+
+    @staticmethod
+    def kind(val):
+        if isinstance(val, bool):
+            return 'bool'
+        if isinstance(val, (int, long, float)):
+            return 'number'
+        if isinstance(val, basestring):
+            return 'string'
+        if isinstance(val, datetime.datetime):
+            return 'datetime'
+        return 'other'
+
+
+class Exporter(object):
+
+    def __init__(self, dbh, out_dir, fmt='parquet', rows_per_group=100000,
+                 batch_size=1000):
+        self.dbh = dbh
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.rows_per_group = rows_per_group
+        self.schemas = {}
+        self.batch_size = batch_size
+        self.partition = 'exported=%s' % datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+
+    def export(self, collections=('loans', 'notes', 'texts'), full=False):
+        state = self.load_state()
+        self.schemas = state.setdefault('schemas', {})
+        if full:
+            state = {'schemas':self.schemas}
+        for name in collections:
+            since = state.get(name)
+            if since is not None:
+                since = datetime.datetime.strptime(since, '%Y-%m-%dT%H:%M:%S.%f')
+            mark = self.export_collection(name, since)
+            state[name] = mark.strftime('%Y-%m-%dT%H:%M:%S.%f')
+            self.save_state(state)
+
+    def export_collection(self, name, since=None):
+        '''
+        write every document of collection 'name' modified after 'since'
+        and return where the next export should start from
+        '''
+        key = KEYS[name]
+        modified = MODIFIED[name]
+        # documents written from here on are left to the next export
+        start = datetime.datetime.utcnow()
+        if since is None:
+            # includes documents that have no 'modified' at all
+            query = {modified:{'$not':{'$gt':start}}}
+        else:
+            query = {modified:{'$gt':since, '$lte':start}}
+        # in index order, an unsorted scan can skip documents that move as they grow
+        cursor = self.dbh[name].find(query).sort(modified, 1).batch_size(self.batch_size)
+
+        writers = {}
+        count = 0
+        for doc in cursor:
+            if name == 'texts':
+                row, children = Exporter.text_row(doc), {}
+            else:
+                doc.pop('_id', None)
+                row, children = Exporter.flatten(doc, key)
+            self.writer(writers, name).add(row)
+            for field in children:
+                for child in children[field]:
+                    self.writer(writers, '%s_%s' % (name, field)).add(child)
+            count += 1
+
+        for table, w in writers.iteritems():
+            w.close()
+            self.schemas[table] = w.spec
+        print 'Exported %s documents from %s' % (count, name)
+        # writes stamped by a clock a little behind ours may still land before start
+        mark = start - CLOCK_SKEW
+        if since is not None and mark < since:
+            mark = since
+        return mark
+
+    def writer(self, writers, table):
+        if table not in writers:
+            path = os.path.join(self.out_dir, table, self.partition, 'part-00000.%s' % self.fmt)
+            writers[table] = TableWriter(path, self.rows_per_group, self.fmt,
+                                         self.schemas.get(table))
+        return writers[table]
+
+    def load_state(self):
+        try:
+            with open(os.path.join(self.out_dir, STATE_FILE)) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+    def save_state(self, state):
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        with open(os.path.join(self.out_dir, STATE_FILE), 'w') as f:
+            json.dump(state, f, indent=2)
+
+    @staticmethod
+    def text_row(text_doc):
+        '''a row of the texts table, decompressed'''
+        if 'zlib' in text_doc:
+            text = zlib.decompress(text_doc['zlib']).decode('utf-8')
+        else:
+            text = text_doc['text']
+        return {'text_id':text_doc['_id'], 'text':text,
+                'length':text_doc.get('length'), 'created':text_doc.get('created')}
+
+    @staticmethod
+    def flatten(doc, key):
+        '''
+        split a document into its row of scalar fields and a dict of
+        field:child rows for its array fields. Subdocuments are flattened
+        into 'field_subfield' columns.
+        '''
+        row = {}
+        children = {}
+        for field, val in doc.iteritems():
+            if isinstance(val, list):
+                rows = []
+                for i in range(len(val)):
+                    child = {key:doc[key], 'idx':i}
+                    if isinstance(val[i], dict):
+                        Exporter.flatten_dict(val[i], '', child)
+                    else:
+                        child['value'] = val[i]
+                    rows.append(child)
+                children[field] = rows
+            elif isinstance(val, dict):
+                Exporter.flatten_dict(val, field + '_', row)
+            else:
+                row[field] = val
+        return row, children
+
+    @staticmethod
+    def flatten_dict(d, prefix, out):
+        for k, v in d.iteritems():
+            if isinstance(v, dict):
+                Exporter.flatten_dict(v, prefix + k + '_', out)
+            elif isinstance(v, list):
+                out[prefix + k] = json.dumps(v, default=str)
+            else:
+                out[prefix + k] = v
+
+
+if __name__ == '__main__':
+
+    from setup_mongodb import get_db
+
+    parser = argparse.ArgumentParser(description='export lc_db to Parquet/Arrow files')
+    parser.add_argument('out_dir')
+    parser.add_argument('--full', action='store_true', help='ignore the last export and write everything')
+    parser.add_argument('--format', default='parquet', choices=['parquet', 'arrow'])
+    parser.add_argument('--collections', nargs='+', default=['loans', 'notes', 'texts'], choices=sorted(KEYS))
+    parser.add_argument('--rows-per-group', type=int, default=100000,
+                        help='rows buffered before a row group is written')
+    parser.add_argument('--batch-size', type=int, default=1000, help='cursor batch size')
+    args = parser.parse_args()
+
+    E = Exporter(get_db('lc_db'), args.out_dir, fmt=args.format,
+                 rows_per_group=args.rows_per_group, batch_size=args.batch_size)
+    E.export(args.collections, full=args.full)
@@ -0,0 +1,197 @@
+'''
+Fast polling change feed for the foliofn trading inventory.
+
+NoteOrdersUpdater does a full pass over the inventory once a day.
+InventoryWatcher instead polls the inventory every few seconds, keeps the
+previous poll in memory keyed by noteID and compares each new poll against
+it. Only notes whose order actually changed produce an event, and only
+those notes are written to db.notes.
+
+Events are put on a Queue.Queue ('watcher.events') for consumers:
+
+    NEW_LISTING    a note appeared in the inventory (trading_status -> True)
+    PRICE_CHANGE   the asking price, markup or ytm of a listed note moved
+    DELISTED       a note left the inventory (trading_status -> False)
+
+When the watcher writes to the db, the first poll is compared against the
+notes listed in db.notes, so changes since the last run aren't missed. A
+change whose db write fails is kept out of the snapshot, so it is found
+(and emitted) again on the next poll.
+'''
+
+import time
+import datetime
+import threading
+import Queue
+from collections import namedtuple
+from data_scrapers import NoteOrders
+
+NEW_LISTING = 'new_listing'
+PRICE_CHANGE = 'price_change'
+DELISTED = 'delisted'
+
+# 'note' is the current note order (None when delisted), 'previous' the
+# order from the poll before (None for a new listing, or if the note
+# was only known from db.notes)
+InventoryEvent = namedtuple('InventoryEvent', ['kind', 'noteID', 'note', 'previous', 'time'])
+
+
+class InventoryWatcher(object):
+
+    price_fields = ['asking_price', 'markup_discount', 'ytm']
+
+    def __init__(self, session, interval=30, updater=None, events=None,
+                 page_size=999999):
+        '''
+        'interval' is the time (sec) between polls.
+        'updater' is a NoteOrdersUpdater used to write changed notes to the
+        db, if None the watcher only emits events.
+        'events' is the queue events are put on, a new one by default.
+        '''
+        self.NO = NoteOrders(session=session)
+        self.interval = interval
+        self.updater = updater
+        self.page_size = page_size
+        if events is None:
+            events = Queue.Queue()
+        self.events = events
+
+        # noteID -> (price fingerprint, note order) from the last poll
+        self.snapshot = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        '''poll until stop() is called'''
+        while not self.stopped.is_set():
+            start = time.time()
+            try:
+                self.poll()
+            except Exception, e:
+                print 'Inventory poll failed: %s' % e
+            self.stopped.wait(max(0, self.interval - (time.time() - start)))
+
+    def start(self):
+        '''run in a background thread, returns the thread'''
+        t = threading.Thread(target=self.run, name='InventoryWatcher')
+        t.daemon = True
+        t.start()
+        return t
+
+    def stop(self):
+        self.stopped.set()
+
+    def poll(self):
+        '''fetch the inventory once, emit and store what changed'''
+        self.NO.grab_data(0, self.page_size)
+        current = {}
+        for note in self.NO.get_data():
+            try:
+                current[int(note['noteId'])] = (self.fingerprint(note), note)
+            except (KeyError, ValueError):
+                continue
+
+        if self.snapshot is None:
+            if self.updater is None:
+                # first poll, nothing to compare against yet
+                self.snapshot = current
+                return []
+            self.snapshot = self.db_snapshot()
+
+        previous = self.snapshot
+        events = self.diff(previous, current)
+        for e in events:
+            self.events.put(e)
+        failed = set()
+        if self.updater is not None:
+            # other processes write db.notes between polls
+            self.updater.cache.clear()
+            failed = self.store(events)
+
+        # leave failed changes out of the snapshot so they're retried
+        for noteID in failed:
+            if noteID in previous:
+                current[noteID] = previous[noteID]
+            else:
+                current.pop(noteID, None)
+        self.snapshot = current
+        return events
+
+    def db_snapshot(self):
+        '''the notes db.notes has as listed, in the same form as a poll'''
+        fields = {'noteID':1}
+        for f in self.price_fields:
+            fields[f] = {'$slice':-1}
+        snapshot = {}
+        for note_doc in self.updater.notes.find({'trading_status':True}, fields):
+            fp = tuple(InventoryWatcher.to_float((note_doc.get(f) or [{}])[-1].get(f))
+                       for f in self.price_fields)
+            snapshot[note_doc['noteID']] = (fp, None)
+        return snapshot
+
+    def diff(self, previous, current):
+        '''return the InventoryEvents that take 'previous' to 'current' '''
+        now = datetime.datetime.utcnow()
+        events = []
+        for noteID, (fp, note) in current.iteritems():
+            old = previous.get(noteID)
+            if old is None:
+                events.append(InventoryEvent(NEW_LISTING, noteID, note, None, now))
+            elif old[0] != fp:
+                events.append(InventoryEvent(PRICE_CHANGE, noteID, note, old[1], now))
+        for noteID in previous:
+            if noteID not in current:
+                events.append(InventoryEvent(DELISTED, noteID, None, previous[noteID][1], now))
+        return events
+
+    def store(self, events):
+        '''push the changed notes through to db.notes, returns the noteIDs that failed'''
+        notes = self.updater.notes
+        failed = set()
+        for e in events:
+            try:
+                if e.kind == DELISTED:
+                    notes.update({'noteID':e.noteID},
+                                 {'$set':{'trading_status':False,
+                                          'modified':datetime.datetime.utcnow()}}, safe=True)
+                    self.updater.cache.notes.invalidate(e.noteID)
+                    continue
+                self.updater.update_note(e.note)
+                if e.kind == NEW_LISTING:
+                    notes.update({'noteID':e.noteID},
+                                 {'$set':{'trading_status':True,
+                                          'modified':datetime.datetime.utcnow()}}, safe=True)
+                    self.updater.cache.notes.invalidate(e.noteID)
+            except Exception, ex:
+                print 'Failed to store %s for note %s: %s' % (e.kind, e.noteID, ex)
+                failed.add(e.noteID)
+        return failed
+
+    def fingerprint(self, note):
+        return tuple(InventoryWatcher.to_float(note.get(f)) for f in self.price_fields)
+
+    @staticmethod
+    def to_float(val):
+        '''prices come as strings from foliofn and floats from the db, None for 'null' '''
+        try:
+            return float(val)
+        except (TypeError, ValueError):
+            return None
+
+
+if __name__ == '__main__':
+
+    from sessions import SessionManager
+    from db_updaters import NoteOrdersUpdater
+
+    session = SessionManager(login='', pwd='', cookie_file='lc_cookies.txt')
+    watcher = InventoryWatcher(session, interval=30, updater=NoteOrdersUpdater(session))
+    watcher.start()
+    while True:
+        try:
+            e = watcher.events.get(timeout=1)
+        except Queue.Empty:
+            continue
+        except KeyboardInterrupt:
+            watcher.stop()
+            break
+        print '%s %s' % (e.kind, e.noteID)
@@ -0,0 +1,213 @@
+'''
+Adaptive request pacing for the page crawlers.
+
+FetchController wraps every page request made by a PageCrawler. It keeps
+a request rate (requests/sec) that is adjusted AIMD style:
+
+- additive increase: every fast, healthy response nudges the rate up
+- multiplicative decrease: throttling (429), server errors (5xx) and
+  timeouts cut the rate down
+
+Failed requests are retried with jittered exponential backoff. If too many
+requests fail in a row the circuit breaker opens and further requests fail
+fast until a cooldown has passed, after which a single probe request is let
+through. Params that could not be fetched because of a transient error
+are kept in 'dead_letters' so they can be saved with 'save_dead_letters'
+and re-queued on the next run. Params that failed for good (e.g. a 404 for
+a note page that's gone) are kept apart in 'failed' and are not retried.
+'''
+
+import os
+import time
+import json
+import random
+import socket
+import mechanize
+
+
+class FetchError(Exception):
+    '''Raised when a page could not be fetched after all retries'''
+    pass
+
+
+class CircuitOpenError(FetchError):
+    '''Raised when the circuit breaker is open and requests are refused'''
+    pass
+
+
+class LoginError(FetchError):
+    '''Raised when a crawler can't log in to get a page'''
+    pass
+
+
+class FetchController(object):
+
+    THROTTLE_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, delay=2, min_delay=0.25, max_delay=60,
+                 increase=0.05, decrease=0.5, slow_latency=3.0,
+                 max_retries=4, backoff_base=1.0, backoff_cap=120,
+                 failure_threshold=5, cooldown=300):
+        '''
+        'delay' is the starting time (sec) between requests, it is converted
+        to a rate and is bounded by 'min_delay' and 'max_delay'.
+        'increase' is the rate (req/sec) added after each fast response and
+        'decrease' the factor the rate is multiplied by after a throttle.
+        A response slower than 'slow_latency' (sec) is treated as a warning
+        sign and does not speed the crawl up.
+        '''
+        self.min_rate = 1.0 / max_delay
+        self.max_rate = 1.0 / min_delay
+        self.rate = self.clamp(1.0 / delay)
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_latency = slow_latency
+
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+        self.last_request = None
+        self.dead_letters = []
+        self.failed = []
+
+    def fetch(self, func, param):
+        '''
+        call func(param), pacing, timing and retrying as necessary, and
+        return its result. Raises FetchError if every attempt failed, the
+        param is dead lettered if the error was transient and put in
+        'failed' if not. Raises CircuitOpenError if the breaker is open
+        (param is not dead lettered, it's up to the caller to wait or give up).
+        '''
+        self.check_circuit()
+
+        for attempt in range(self.max_retries + 1):
+            self.wait()
+            start = time.time()
+            try:
+                result = func(param)
+            except Exception, e:
+                retry_after = self.on_failure(e)
+                if retry_after is None:
+                    self.failed.append(param)
+                    raise FetchError('failed to fetch %s for good: %s' % (str(param), e))
+                if attempt == self.max_retries:
+                    self.dead_letters.append(param)
+                    raise FetchError('failed to fetch %s: %s' % (str(param), e))
+                print 'Retrying %s in %.1fs (%s)' % (str(param), retry_after, e)
+                time.sleep(retry_after)
+                if self.circuit_open():
+                    raise CircuitOpenError('circuit open, gave up on %s' % str(param))
+                continue
+
+            self.on_success(time.time() - start)
+            return result
+
+    def wait(self):
+        '''sleep long enough to keep to the current rate'''
+        if self.last_request is not None:
+            remaining = self.last_request + self.get_delay() - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+        self.last_request = time.time()
+
+    def on_success(self, latency):
+        self.consecutive_failures = 0
+        self.opened_at = None
+        if latency < self.slow_latency:
+            self.rate = self.clamp(self.rate + self.increase)
+
+    def on_failure(self, error):
+        '''
+        update rate and breaker state after a failed request, return the
+        number of seconds to wait before retrying or None if the error
+        isn't worth retrying
+        '''
+        if not self.is_retriable(error):
+            # e.g. 404, retrying won't help and it says nothing about load
+            return None
+
+        self.rate = self.clamp(self.rate * self.decrease)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.time()
+
+        retry_after = self.retry_after_header(error)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_cap)
+        return self.backoff(self.consecutive_failures - 1)
+
+    def backoff(self, attempt):
+        '''exponential backoff with full jitter'''
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def circuit_open(self):
+        return self.opened_at is not None and \
+            time.time() - self.opened_at < self.cooldown
+
+    def check_circuit(self):
+        '''
+        raise if the breaker is open, once the cooldown has passed
+        the next request is let through as a probe
+        '''
+        if self.circuit_open():
+            raise CircuitOpenError('circuit open for another %.0fs' %
+                                   (self.cooldown - (time.time() - self.opened_at)))
+
+    def wait_for_cooldown(self):
+        '''sleep until the breaker lets a probe request through'''
+        if self.circuit_open():
+            remaining = self.cooldown - (time.time() - self.opened_at)
+            print 'Circuit open, waiting %.0fs before probing' % remaining
+            time.sleep(remaining)
+
+    def save_dead_letters(self, filename, extra=()):
+        '''
+        write the dead letters (plus any 'extra' params) to filename so
+        they can be re-queued by the next run, removes it if there are none
+        '''
+        params = []
+        for p in list(self.dead_letters) + list(extra):
+            if p not in params:
+                params.append(p)
+        if len(params) == 0:
+            if os.path.exists(filename):
+                os.remove(filename)
+            return
+        with open(filename, 'w') as f:
+            json.dump(params, f)
+        print 'Saved %s failed params to %s' % (len(params), filename)
+
+    @staticmethod
+    def load_dead_letters(filename):
+        '''params saved by save_dead_letters, lists come back as tuples'''
+        if filename is None or not os.path.exists(filename):
+            return []
+        with open(filename) as f:
+            return [tuple(p) if isinstance(p, list) else p for p in json.load(f)]
+
+    def get_delay(self):
+        return 1.0 / self.rate
+
+    def clamp(self, rate):
+        return max(self.min_rate, min(self.max_rate, rate))
+
+    @staticmethod
+    def retry_after_header(error):
+        '''seconds from a Retry-After header, if the server sent one'''
+        try:
+            return float(error.info().getheader('Retry-After'))
+        except:
+            return None
+
+    @staticmethod
+    def is_retriable(error):
+        '''True for errors that are likely to be transient'''
+        if isinstance(error, mechanize.HTTPError):
+            return error.code in FetchController.THROTTLE_CODES
+        return isinstance(error, (mechanize.URLError, socket.error, socket.timeout))
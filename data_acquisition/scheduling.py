@@ -0,0 +1,140 @@
+'''
+Decides in which order note pages are crawled.
+
+Crawling is rate limited, so when there are more candidate note pages than
+can be fetched in one cycle the ones that matter most should go first.
+NotePageScheduler scores every candidate and hands them out highest score
+first from a heap, up to a per-cycle budget. The score adds up:
+
+- how much the note order moved (relative change of asking price,
+  outstanding principal and accrued interest since we last stored them)
+- how stale our copy of the note page is (days since 'last_updated')
+- the loan status, late loans change the most and matter the most
+- the remaining principal of the note
+'''
+
+import heapq
+import datetime
+
+
+class NotePageScheduler(object):
+
+    change_fields = ['asking_price', 'outstanding_principal', 'accrued_interest']
+
+    status_weights = {'Current': 0.0,
+                      'Fully Paid': 0.0,
+                      'Charged Off': 0.0,
+                      'Issued': 0.25,
+                      'In Grace Period': 1.0,
+                      'Late (16-30 days)': 1.5,
+                      'Late (31-120 days)': 1.5,
+                      'Default': 1.0,
+                      }
+
+    def __init__(self, days_old=7, w_change=10.0, w_stale=1.0, w_status=1.0,
+                 w_principal=0.5, budget=None):
+        '''
+        'days_old' is the age (days) at which a note page counts as fully
+        stale, the w_* are the weights of each part of the score.
+        'budget' is the most note pages handed out per cycle, None for all.
+        '''
+        self.days_old = days_old
+        self.w_change = w_change
+        self.w_stale = w_stale
+        self.w_status = w_status
+        self.w_principal = w_principal
+        self.budget = budget
+        self.heap = []
+        self.counter = 0
+        # tuples in the heap that haven't been handed out yet
+        self.queued = set()
+
+    def push(self, note_tup, score):
+        '''
+        queue a note page, pushing one that's already queued again just
+        moves it up if the new score is higher
+        '''
+        # heapq is a min heap, the counter breaks ties in insertion order
+        heapq.heappush(self.heap, (-score, self.counter, note_tup))
+        self.counter += 1
+        self.queued.add(note_tup)
+
+    def pop_batch(self, n):
+        '''
+        return up to n (loanID,orderID,noteID) tuples, highest score first,
+        without going over the budget
+        '''
+        if self.budget is not None:
+            n = min(n, self.budget)
+        batch = []
+        while len(batch) < n and len(self.heap) > 0:
+            note_tup = heapq.heappop(self.heap)[2]
+            if note_tup in self.queued:
+                # otherwise it's a lower scored duplicate of one handed out already
+                self.queued.remove(note_tup)
+                batch.append(note_tup)
+        if self.budget is not None:
+            self.budget -= len(batch)
+        return batch
+
+    def __len__(self):
+        if self.budget is not None:
+            return min(self.budget, len(self.queued))
+        return len(self.queued)
+
+    def score(self, note_order, note, loan):
+        '''
+        'note_order' is the current foliofn order, 'note' and 'loan' the
+        documents we have for it in the db (or None)
+        '''
+        return self.w_change * self.change_score(note_order, note) + \
+               self.w_stale * self.stale_score(note) + \
+               self.w_status * self.status_score(loan) + \
+               self.w_principal * self.principal_score(note_order)
+
+    def change_score(self, note_order, note):
+        '''largest relative change of the order fields, 1 for unseen notes'''
+        if note is None:
+            return 1.0
+        change = 0.0
+        for f in self.change_fields:
+            try:
+                old = NotePageScheduler.latest(note[f], f)
+                new = float(note_order[f])
+                change = max(change, abs(new - old) / max(abs(old), 0.01))
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue
+        return min(change, 1.0)
+
+    def stale_score(self, note):
+        '''
+        days since last crawled as a fraction of days_old, capped at 4.
+        days_old=0 means every page is due, so everything is fully stale.
+        '''
+        if self.days_old <= 0:
+            return 4.0
+        try:
+            age = datetime.datetime.utcnow() - note['last_updated']
+        except (KeyError, TypeError):
+            return 4.0
+        return min(age.total_seconds() / 86400.0 / self.days_old, 4.0)
+
+    def status_score(self, loan):
+        try:
+            return self.status_weights.get(loan['status'], 0.5)
+        except (KeyError, TypeError):
+            return 0.5
+
+    def principal_score(self, note_order):
+        '''outstanding principal in units of a $25 note, capped at 4'''
+        try:
+            return min(float(note_order['outstanding_principal']) / 25.0, 4.0)
+        except (KeyError, ValueError):
+            return 0.0
+
+    @staticmethod
+    def latest(val, field):
+        '''last value of a time series field like asking_price, or the plain value'''
+        if isinstance(val, list):
+            val = val[-1][field]
+        return float(val)
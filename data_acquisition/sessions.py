@@ -0,0 +1,125 @@
+'''
+Shared, persistent LendingClub login sessions.
+
+A SessionManager owns a single cookie jar that is saved to disk so a login
+survives between runs. Every browser handed out by the manager shares that
+jar, so once any of them logs in they all are. The login is checked lazily:
+nothing is sent to LC until a page actually needs it, or a crawler sees the
+login page, in which case 'reauthenticate' signs in once on behalf of every
+crawler using the manager.
+
+The manager also keeps a small pool of browsers which crawlers borrow with
+'acquire' and hand back with 'release', so concurrent crawls don't each pay
+for setting up and logging in a new browser.
+'''
+
+import os
+import threading
+import Queue
+import mechanize
+import cookielib
+
+
+class SessionManager(object):
+
+    login_url = 'https://www.lendingclub.com/account/gotoLogin.action'
+
+    def __init__(self, login, pwd, cookie_file=None, pool_size=4):
+        '''
+        'cookie_file' is where the cookie jar is saved between runs,
+        if None the session only lives as long as the manager.
+        'pool_size' is the number of idle browsers kept around.
+        '''
+        self.login = login
+        self.password = pwd
+        self.cookie_file = cookie_file
+        self.cj = cookielib.LWPCookieJar()
+        self.load_cookies()
+
+        # bumped every time we sign in, lets crawlers tell whether someone
+        # else already logged in since their page was fetched
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.pool = Queue.Queue(maxsize=pool_size)
+
+    def load_cookies(self):
+        if self.cookie_file is None or not os.path.exists(self.cookie_file):
+            return
+        try:
+            self.cj.load(self.cookie_file, ignore_discard=True)
+            print 'Loaded session cookies from %s' % self.cookie_file
+        except (cookielib.LoadError, IOError), e:
+            print 'Ignoring unreadable cookie file %s: %s' % (self.cookie_file, e)
+
+    def save_cookies(self):
+        if self.cookie_file is None:
+            return
+        self.cj.save(self.cookie_file, ignore_discard=True)
+        os.chmod(self.cookie_file, 0600)
+
+    def new_browser(self):
+        br = mechanize.Browser()
+        br.set_cookiejar(self.cj)
+        br.set_handle_robots(False)
+        return br
+
+    def acquire(self):
+        '''borrow a browser from the pool, making a new one if it is empty'''
+        try:
+            return self.pool.get_nowait()
+        except Queue.Empty:
+            return self.new_browser()
+
+    def release(self, br):
+        '''hand a browser back to the pool'''
+        try:
+            self.pool.put_nowait(br)
+        except Queue.Full:
+            pass
+
+    def warm(self, n=None):
+        '''
+        pre-authenticate and fill the pool with 'n' browsers
+        (default: the pool size) ready for a concurrent crawl
+        '''
+        self.ensure_login()
+        if n is None:
+            n = self.pool.maxsize
+        for i in range(n - self.pool.qsize()):
+            self.release(self.new_browser())
+
+    def ensure_login(self):
+        '''
+        sign in only if there are no cookies at all, a saved session
+        is assumed to be good until a page says otherwise
+        '''
+        if len(self.cj) == 0:
+            self.reauthenticate(self.generation)
+
+    def reauthenticate(self, generation):
+        '''
+        Sign in again after a crawler saw the login page. 'generation' is
+        the value of self.generation when that page was fetched, if another
+        crawler has signed in since then there's nothing to do.
+        '''
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.sign_in()
+            self.generation += 1
+            self.save_cookies()
+
+    def sign_in(self):
+        '''Sign into LendingClub'''
+        br = self.acquire()
+        try:
+            br.open(self.login_url)
+            br.select_form(nr=0)
+            br.form['login_email'] = self.login
+            br.form['login_password'] = self.password
+            br.submit()
+            print 'logged in as %s' % self.login
+        except:
+            raise Exception('failed to login')
+        finally:
+            self.release(br)
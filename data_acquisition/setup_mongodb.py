@@ -1,29 +1,84 @@
 import sys
-from pymongo import Connection
-from pymongo.errors import ConnectionFailure
-import datetime
 
 def get_db(db_name):
     '''Connect to MongoDB'''
+    from pymongo import Connection
+    from pymongo.errors import ConnectionFailure
     try:
         c = Connection(host='localhost', port=27017)
         print 'Connected to DB successfully'
     except ConnectionFailure, e:
         sys.stderr.write('Could not connect to MongoDB: %s' % e)
         sys.exit(1)
-        
+
     # Get a database handle to a database named 'mydb'
     dbh = c[db_name]
-    
+
     assert dbh.connection == c
     print 'Successfully set up a database handle'
-    
+
     return dbh
-    
+
+
+class LazyDB(object):
+    '''
+    Stands in for a database handle without connecting. Collections
+    are LazyCollections, the connection is opened the first time one
+    of them is actually used and is then shared by all of them.
+    '''
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.dbh = None
+
+    def connect(self):
+        if self.dbh is None:
+            self.dbh = get_db(self.db_name)
+        return self.dbh
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return LazyCollection(self, name)
+
+    def __getitem__(self, name):
+        return LazyCollection(self, name)
+
+
+class LazyCollection(object):
+    '''A collection of a LazyDB, connects on first use'''
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.collection = None
+
+    def __getattr__(self, attr):
+        if self.collection is None:
+            self.collection = self.db.connect()[self.name]
+        return getattr(self.collection, attr)
+
+
+_lazy_dbs = {}
+
+def lazy_db(db_name):
+    '''return a shared LazyDB for db_name, nothing is opened until it is used'''
+    if db_name not in _lazy_dbs:
+        _lazy_dbs[db_name] = LazyDB(db_name)
+    return _lazy_dbs[db_name]
+
 
 if __name__ == '__main__':
-    
+
     dbh = get_db('lc_db')
-    
+
     dbh.notes.create_index('noteID', unique=True)
     dbh.loans.create_index('loanID', unique=True)
+    # notes of a loan: analytics refreshes, stamping crawled loans' notes
+    dbh.notes.create_index('loanID')
+    # incremental exports
+    dbh.notes.create_index('modified')
+    dbh.loans.create_index('modified')
+    dbh.texts.create_index('created')
+    dbh.note_analytics.create_index('noteID', unique=True)
+    dbh.note_analytics.create_index('loanID')
@@ -0,0 +1,103 @@
+'''
+Content addressed storage for the long text fields of loan documents.
+
+Loan descriptions and Q&A answers are often boilerplate that is repeated
+word for word across many loans. Rather than keep a copy in every loan
+document, TextStore saves each distinct text once in its own collection
+(db.texts), keyed by the sha1 of the text, and the loan document keeps
+only the key:
+
+    {'description': '...'}  -->  {'description_ref': '<sha1>'}
+    QA: [{'answer': '...'}]  -->  QA: [{'answer_ref': '<sha1>'}]
+
+Texts can optionally be zlib compressed. 'resolve' puts the text back into
+a document, and works on documents written before the store existed.
+
+Since every distinct text lives in one collection, that is also the place
+to put a full text index over descriptions later on.
+'''
+
+import zlib
+import hashlib
+import datetime
+
+
+class TextStore(object):
+
+    def __init__(self, collection, compress=False, min_length=64, max_seen=100000):
+        '''
+        'collection' is the db collection holding the texts.
+        Texts shorter than 'min_length' characters stay in the document,
+        a reference would save next to nothing.
+        'max_seen' bounds the number of keys remembered as stored.
+        '''
+        self.texts = collection
+        self.compress = compress
+        self.min_length = min_length
+        self.max_seen = max_seen
+        # keys known to be in the collection, saves a round trip per repeat
+        self.seen = set()
+
+    def put(self, text):
+        '''store text if it isn't stored already, return its key'''
+        data = text.encode('utf-8')
+        key = hashlib.sha1(data).hexdigest()
+        if key in self.seen:
+            return key
+
+        text_doc = {'length':len(text), 'created':datetime.datetime.utcnow()}
+        packed = zlib.compress(data) if self.compress else None
+        if packed is not None and len(packed) < len(data):
+            from bson.binary import Binary
+            text_doc['zlib'] = Binary(packed)
+        else:
+            text_doc['text'] = text
+
+        # only the first writer of a text inserts it, later ones are no-ops
+        self.texts.update({'_id':key}, {'$setOnInsert':text_doc},
+                          upsert=True, safe=True)
+        if len(self.seen) >= self.max_seen:
+            # forgetting a key only costs another (no-op) upsert
+            self.seen.clear()
+        self.seen.add(key)
+        return key
+
+    def get(self, key):
+        '''return the text stored under key'''
+        text_doc = self.texts.find_one({'_id':key})
+        if text_doc is None:
+            raise KeyError('no text stored for %s' % key)
+        if 'zlib' in text_doc:
+            return zlib.decompress(text_doc['zlib']).decode('utf-8')
+        return text_doc['text']
+
+    def externalize(self, doc):
+        '''
+        move the long text fields of a parsed loan doc into the store,
+        replacing them with references. Modifies and returns doc.
+        '''
+        self.externalize_field(doc, 'description')
+        for qa in doc.get('QA', []):
+            self.externalize_field(qa, 'question')
+            self.externalize_field(qa, 'answer')
+        return doc
+
+    def externalize_field(self, doc, field):
+        text = doc.get(field)
+        if text is None or len(text) < self.min_length:
+            return
+        doc[field + '_ref'] = self.put(text)
+        del doc[field]
+
+    def resolve(self, doc):
+        '''inverse of externalize, fills referenced texts back into doc'''
+        self.resolve_field(doc, 'description')
+        for qa in doc.get('QA', []):
+            self.resolve_field(qa, 'question')
+            self.resolve_field(qa, 'answer')
+        return doc
+
+    def resolve_field(self, doc, field):
+        key = doc.pop(field + '_ref', None)
+        if key is not None:
+            doc[field] = self.get(key)